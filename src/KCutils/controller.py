@@ -23,6 +23,31 @@ import numpy as np
 import itertools
 
 
+# cached result of the MA27 availability probe (None = not yet probed)
+_HAVE_MA27 = None
+
+def _have_ma27():
+    """
+    This function checks whether IPOPT can use the HSL MA27 linear solver.
+    An unavailable linear solver only surfaces as an Invalid_Option status
+    when a solver instance is actually run, so a trivial NLP is constructed
+    and solved once; the result is cached for subsequent calls.
+    """
+    global _HAVE_MA27
+    if _HAVE_MA27 is None:
+        try:
+            x = cas.SX.sym('x')
+            probe = cas.nlpsol('ma27_probe', 'ipopt', {'x': x, 'f': x**2},
+                               {'print_time': 0,
+                                'ipopt': {'print_level': 0, 'sb': 'yes',
+                                          'linear_solver': 'ma27'}})
+            probe(x0=0)
+            _HAVE_MA27 = probe.stats()['return_status'] != 'Invalid_Option'
+        except Exception:
+            _HAVE_MA27 = False
+    return _HAVE_MA27
+
+
 class MPC():
     """
     MPC is a super class designed to be a template for particular
@@ -97,6 +122,11 @@ class EconomicMPC(MPC):
     def __init__(self, prob_info):
         super(EconomicMPC, self).__init__(prob_info)
         self.mpc_type = 'economic'
+        # contiguous copies of the input bounds for the fallback clamp in
+        # solve_mpc, so the bounds are not re-fetched from prob_info on every
+        # solve
+        self._u_lo = np.ascontiguousarray(prob_info['u_min'], dtype=np.float64)
+        self._u_hi = np.ascontiguousarray(prob_info['u_max'], dtype=np.float64)
 
     def get_mpc(self):
         """
@@ -129,7 +159,6 @@ class EconomicMPC(MPC):
 
         u_init = self.prob_info['u_init']
         x_init = self.prob_info['x_init']
-        y_init = self.prob_info['y_init']
 
         f = self.prob_info['f']
         h = self.prob_info['h']
@@ -144,66 +173,117 @@ class EconomicMPC(MPC):
             du_min = self.prob_info['du_min']
             constrain_dinput = True
 
+        # expand any supplied MX functions to SX before building the problem;
+        # SX gives a smaller, faster-to-differentiate graph for the small
+        # dense expressions used here (no-op for functions that are already
+        # SX, as produced by the config scripts)
+        def _expand_to_sx(fun):
+            if fun.class_name() != 'MXFunction':
+                return fun
+            try:
+                return fun.expand()
+            except Exception:
+                # inherently MX functions (e.g. integrator calls) cannot be
+                # expanded; keep them as-is
+                return fun
+        f = _expand_to_sx(f)
+        h = _expand_to_sx(h)
+        lstage = _expand_to_sx(lstage)
+        if reduce_dinput:
+            ustage = _expand_to_sx(ustage)
+
+        # convert the constant bounds and the zero predicted-noise vector to
+        # CasADi DMs once, so the horizon loop below does not redo a
+        # NumPy-to-DM conversion (plus a fresh allocation for the zeros) on
+        # every subject_to/lstage call
+        u_min = cas.DM(u_min)
+        u_max = cas.DM(u_max)
+        x_min = cas.DM(x_min)
+        x_max = cas.DM(x_max)
+        y_min = cas.DM(y_min)
+        y_max = cas.DM(y_max)
+        zero_w = cas.DM.zeros(nw, 1)
+
         # create NLP opti object
         opti = cas.Opti()
 
-        # Initialize container lists for all states, inputs, outputs, and
-        # predicted noise over horizon
-        X = [0 for j in range(Np+1)]
-        Y = [0 for j in range(Np+1)]
-        U = [0 for j in range(Np)]
-        wPred = [0 for j in range(Np)]
-
         J = 0 # initialize cost/objective function
 
-        CEMref = opti.parameter(nyc) # target/reference output
-        opti.set_value(CEMref, np.zeros((nyc,1)))
-
-        CEM0 = opti.parameter(nyc) # initial thickness
-        opti.set_value(CEM0, np.zeros((nyc,1)))
-
-        # define parameter(s), variable(s), and problem
-        X[0] = opti.parameter(nx) # initial state as a parameter
-        opti.set_value(X[0], np.zeros((nx,1)))
-
-        Y[0] = opti.variable(ny) # initial output variable
-        opti.subject_to(Y[0] == h(X[0]))
-        opti.set_initial(Y[0], y_init)
-
-        # the loop below systematically defines the variables of the optimal
-        # control problem (OCP) over the prediction horizon
+        # all problem parameters are packed into a single vector parameter so
+        # that set_parameters() updates them with one set_value call per step
+        # instead of three
+        P = opti.parameter(nx + 2*nyc)
+        opti.set_value(P, np.zeros((nx + 2*nyc,1)))
+
+        X0 = P[:nx]            # initial state
+        CEMref = P[nx:nx+nyc]  # target/reference output
+        CEM0 = P[nx+nyc:]      # initial CEM dose
+
+        # declare each trajectory as a single matrix variable with one column
+        # per stage rather than Np separate Opti variables per container;
+        # building the variables in bulk cuts the Python-side
+        # graph-construction work and makes the stacked constraints below
+        # simple slices
+        Uall = opti.variable(nu, Np)   # u_0 ... u_{Np-1}
+        Xall = opti.variable(nx, Np)   # x_1 ... x_Np
+
+        # per-stage column views of the trajectories (X[0] is the parameter)
+        X = [X0] + [Xall[:,k] for k in range(Np)]
+        U = [Uall[:,k] for k in range(Np)]
+
+        # the outputs are pure functions of the states, so they are kept as
+        # symbolic expressions rather than decision variables tied to the
+        # states by ny*(Np+1) equality constraints; this removes those rows
+        # (and variables) from the KKT system entirely
+        h_map = h.map(Np+1)
+        Yall = h_map(cas.horzcat(X0, Xall)) # y_0 ... y_Np
+        # kept for reconstructing outputs on the solve_mpc fallback path
+        self._h_map = h_map
+
+        # initial-guess tiles, computed once here and reused by
+        # reset_initial_guesses(); each trajectory gets its guess through a
+        # single set_initial call on the matrix variable
+        self._u_init_tile = np.tile(np.reshape(u_init,(-1,1)), (1,Np))
+        self._x_init_tile = np.tile(np.reshape(x_init,(-1,1)), (1,Np))
+        opti.set_initial(Uall, self._u_init_tile)
+        opti.set_initial(Xall, self._x_init_tile)
+
+        # the loop below builds the objective over the prediction horizon;
+        # the bound and dynamics constraints are stacked after the loop and
+        # imposed with one subject_to call per constraint type
         for k in range(Np):
-            # variable and constraints for u_{k}
-            U[k] = opti.variable(nu)
-            opti.subject_to(opti.bounded(u_min, U[k], u_max))
-            opti.set_initial(U[k], u_init)
-
-            Jstage = lstage(X[k], np.zeros((nw,1)))
+            Jstage = lstage(X[k], zero_w)
             J += Jstage # add to the cost (construction of the objective)
 
-            # variable x_{k+1}
-            X[k+1] = opti.variable(nx)
-            opti.subject_to(opti.bounded(x_min, X[k+1], x_max))
-            opti.set_initial(X[k+1], x_init)
-
-            # variable y_{k+1}
-            Y[k+1] = opti.variable(ny)
-            opti.subject_to(opti.bounded(y_min, Y[k+1], y_max))
-            opti.set_initial(Y[k+1], y_init)
-
-            # dynamics constraint
-            opti.subject_to(X[k+1] == f(X[k],U[k],wPred[k]))
-
-            # output equality constraint
-            opti.subject_to(Y[k+1] == h(X[k+1]))
-
             if k>0 and reduce_dinput:
                 J += ustage(U[k],U[k-1])
-            elif k>0 and constrain_dinput:
-                opti.subject_to(opti.bounded(du_min, U[k]-U[k-1], du_max))
+
+        # stacked views of the per-stage variables (one column per stage)
+        U_stack = Uall                             # nu x Np
+        X_stack = Xall                             # nx x Np
+        Y_stack = Yall[:,1:]                       # ny x Np
+        Xprev_stack = cas.horzcat(X0, Xall[:,:-1]) # nx x Np
+        W_stack = cas.DM.zeros(nw, Np)             # predicted noise over the horizon
+
+        # bound constraints (one stacked call per container); the output
+        # bounds become inequalities on h(x_{k+1})
+        opti.subject_to(opti.bounded(cas.repmat(u_min,1,Np), U_stack, cas.repmat(u_max,1,Np)))
+        opti.subject_to(opti.bounded(cas.repmat(x_min,1,Np), X_stack, cas.repmat(x_max,1,Np)))
+        opti.subject_to(opti.bounded(cas.repmat(y_min,1,Np), Y_stack, cas.repmat(y_max,1,Np)))
+
+        # dynamics constraints, evaluated over the whole horizon via a mapped
+        # function
+        opti.subject_to(cas.vec(X_stack) == cas.vec(f.map(Np)(Xprev_stack, U_stack, W_stack)))
+
+        # the hard rate-of-change bound only applies when the soft ustage
+        # penalty is not in use (mirroring the per-stage if/elif this
+        # replaced)
+        if constrain_dinput and not reduce_dinput and Np > 1:
+            dU = U_stack[:,1:] - U_stack[:,:-1]
+            opti.subject_to(opti.bounded(cas.repmat(du_min,1,Np-1), dU, cas.repmat(du_max,1,Np-1)))
 
         # terminal cost and constraints
-        J_end = lstage(X[-1], np.zeros((nw,1)))
+        J_end = lstage(X[-1], zero_w)
         J += J_end
 
         Jcon = J + CEM0
@@ -213,22 +293,76 @@ class EconomicMPC(MPC):
         opti.minimize( J )
 
         # set solver options
-        p_opts = {'verbose': 0,
-                  'expand': True,
-                  'print_time': 0}          # problem options
+        # JIT-compile the NLP callbacks (objective/constraint/derivative
+        # evaluations) so IPOPT calls native code instead of evaluating them
+        # through CasADi's virtual machine; the generated sources/library are
+        # removed again when the solver is freed (jit_cleanup) so repeated
+        # runs do not litter the working directory
+        p_opts = {'expand': True,
+                  'print_time': 0,
+                  'jit': True,
+                  'compiler': 'shell',
+                  'jit_options': {'flags': ['-O3', '-march=native'], 'verbose': False},
+                  'jit_cleanup': True,
+                  # embed the compiled code when serializing the solver
+                  'jit_serialize': 'embed',
+                  # pass the variable bounds to IPOPT as simple bounds rather
+                  # than general constraint rows, shrinking the constraint
+                  # Jacobian by Np*(nu+nx+ny)*2 rows
+                  'detect_simple_bounds': True}  # problem options
         s_opts = {'max_iter': 1000,
                   'print_level': 0,
-                  'tol': 1e-6}              # solver options
+                  'tol': 1e-6,
+                  # adaptive barrier updates typically cut the iteration count
+                  # versus the default monotone strategy on this problem size
+                  'mu_strategy': 'adaptive',
+                  # the HSL MA27 linear solver is faster than MUMPS on the
+                  # small KKT systems of this MPC; use the bundled MUMPS
+                  # solver when the HSL routines are not installed
+                  'linear_solver': 'ma27' if _have_ma27() else 'mumps',
+                  'hessian_approximation': 'exact',
+                  'fixed_variable_treatment': 'make_parameter',
+                  # have IPOPT start from the primal/dual warm starts supplied
+                  # through the cached solver Function rather than its default
+                  # initialization heuristics
+                  'warm_start_init_point': 'yes',
+                  'mu_init': 1e-4,
+                  'warm_start_bound_push': 1e-8,
+                  'warm_start_mult_bound_push': 1e-8}  # solver options
         opti.solver('ipopt', p_opts, s_opts) # add the solver to the opti object
 
-        # save list containers of variables/parameters into a dict for portability
+        # compile the OCP into a standalone CasADi Function so that repeated
+        # calls to solve_mpc() reuse the same solver instance rather than
+        # re-running the Opti presolve bookkeeping on every solve; the primal
+        # and dual warm starts are threaded through the Function as two dense
+        # vectors instead of being set variable-by-variable
+        self._solve_fn = opti.to_function('mpc_step',
+                                          [P, opti.x, opti.lam_g],
+                                          [U[0], Uall, Xall, Yall, J,
+                                           opti.x, opti.lam_g])
+
+        # initial warm-start vector, ordered to match the declaration order of
+        # the matrix variables above (Uall then Xall, each vectorized
+        # column-major)
+        self._x_ws0 = np.concatenate([np.tile(u_init, Np), np.tile(x_init, Np)])
+        self._x_ws = cas.DM(self._x_ws0)
+        self._lam_ws = cas.DM.zeros(opti.lam_g.size1())
+
+        # default parameter values (overwritten by set_parameters())
+        self._p_val = np.zeros((nx + 2*nyc,))
+        self._x0_val = np.zeros((nx,))
+        self._cemref_val = np.zeros((nyc,))
+        self._cem0_val = np.zeros((nyc,))
+
+        # save containers of variables/parameters into a dict for portability
         opti_vars = {}
-        opti_vars['U'] = U
-        opti_vars['X'] = X[1:]
-        opti_vars['Y'] = Y
+        opti_vars['U'] = Uall
+        opti_vars['X'] = Xall
+        opti_vars['Y'] = Yall
         opti_vars['J'] = J
 
         opti_params  = {}
+        opti_params['P'] = P
         opti_params['X0'] = X[0]
         opti_params['CEMref'] = CEMref
         opti_params['CEM0'] = CEM0
@@ -248,87 +382,66 @@ class EconomicMPC(MPC):
         been called (i.e., the optimization problme must be defined before it
         can be solved).
         """
-        # extract all keys from the opti variables dict
-        opti_var_keys = [*self.opti_vars]
-        opti_param_keys = [*self.opti_params]
-
-        # unpack relevant information from problem creation
-        u_min = self.prob_info['u_min']
-        u_max = self.prob_info['u_max']
-
         feas = True
         res = {}
         try:
-            sol = self.opti.solve()
-
-            for key in opti_var_keys:
-                if key == 'J':
-                    res[key] = sol.value(self.opti_vars[key])
-                else:
-                    var = self.opti_vars[key]
-                    r = len(var) # Np
-                    nx = (var[0]).size1()
-                    values = np.zeros((nx,r))
-                    for j in range(r):
-                        values[:,j,] = sol.value(var[j])
-
-                    res[key] = values
-
-            res['Ufull'] = res['U']
-            res['U'] = res['U'][:,0]
-
-            for key in opti_param_keys:
-                if key in ['CEMref', 'CEM0', 'X0']:
-                    res[key] = sol.value(self.opti_params[key])
-                else:
-                    var = self.opti_params[key]
-                    r = len(var) # Np
-                    nx = (var[0]).size1()
-                    values = np.zeros((nx,r))
-                    for j in range(r):
-                        values[:,j] = sol.value(var[j])
-
-                    res[key] = values
-
-            if warm_start:
-                self.opti.set_initial(sol.value_variables())
+            # call the cached solver Function built in get_mpc(); this reuses
+            # the same IPOPT instance across solves and returns the solution
+            # as stacked arrays in a single call
+            u0, Uall, Xall, Yall, Jval, x_opt, lam_opt = self._solve_fn(
+                self._p_val, self._x_ws, self._lam_ws)
+
+            feas = bool(self._solve_fn.stats()['success'])
+
+            res['U'] = np.ravel(u0.full())
+            res['Ufull'] = Uall.full()
+            res['X'] = Xall.full()
+            res['Y'] = Yall.full()
+            res['J'] = float(Jval)
+
+            res['X0'] = self._x0_val
+            res['CEMref'] = self._cemref_val
+            res['CEM0'] = self._cem0_val
+
+            if feas:
+                if warm_start:
+                    self._x_ws = x_opt
+                    self._lam_ws = lam_opt
+            else:
+                # the solver Function returns the last iterate even when the
+                # solve fails; clamp the input to its bounds before use
+                np.clip(res['U'], self._u_lo, self._u_hi, out=res['U'])
 
         except Exception as e:
             print(e)
-            # if solve fails, get the last value
+            # hard CasADi failure (e.g. NaN parameters or a JIT error at call
+            # time); all solves go through the detached solver Function, so
+            # the Opti stack holds no solution to fall back on. Rebuild a
+            # usable fallback from the current warm start, with the first
+            # input clamped to its bounds
             feas = False
 
-            for key in opti_var_keys:
-                if key == 'J':
-                    res[key] = self.opti.debug.value(self.opti_vars[key])
-                else:
-                    var = self.opti_vars[key]
-                    r = len(var) # Np
-                    nx = (var[0]).size1()
-                    values = np.zeros((nx,r))
-                    for j in range(r):
-                        values[:,j] = self.opti.debug.value(var[j])
-
-                    res[key] = values
-
-            res['Ufull'] = res['U']
-            res['U'] = res['U'][:,0]
-
-            for key in opti_param_keys:
-                if key in ['CEMref', 'CEM0', 'X0']:
-                    res[key] = self.opti.debug.value(self.opti_params[key])
-                else:
-                    var = self.opti_params[key]
-                    r = len(var) # Np
-                    nx = (var[0]).size1()
-                    values = np.zeros((nx,r))
-                    for j in range(r):
-                        values[:,j] = self.opti.debug.value(var[j])
-
-                    res[key] = values
-
-            u = res['U']
-            res['U'] = np.maximum(np.minimum(u, u_max), u_min)
+            Np = self.prob_info['Np']
+            nu = self.prob_info['nu']
+            nx = self.prob_info['nx']
+
+            # the warm-start vector stacks vec(Uall) then vec(Xall)
+            ws = np.asarray(self._x_ws).reshape(-1)
+            Ufb = ws[:nu*Np].reshape((nu,Np), order='F')
+            Xfb = ws[nu*Np:].reshape((nx,Np), order='F')
+
+            res['Ufull'] = Ufb
+            res['X'] = Xfb
+            res['Y'] = np.asarray(self._h_map(np.hstack((self._x0_val.reshape(-1,1), Xfb))))
+            res['J'] = np.nan
+
+            res['X0'] = self._x0_val
+            res['CEMref'] = self._cemref_val
+            res['CEM0'] = self._cem0_val
+
+            u = np.array(Ufb[:,0])
+            np.clip(u, self._u_lo, self._u_hi, out=u)
+            res['U'] = u
             # print('U_0:', res['U'])
             # print('J:', res['J'])
 
@@ -340,22 +453,19 @@ class EconomicMPC(MPC):
         optimization problem back to those defined in the problem_info dict
         provided upon instantiation of the OffsetFreeMPC object.
         """
-        # unpack relevant information from the prob_info dict
-        Np = self.prob_info['Np']
-        u_init = self.prob_info['u_init']
-        x_init = self.prob_info['x_init']
-        y_init = self.prob_info['y_init']
-
-        # unpack relevant variable containers from problem creation
+        # unpack relevant variable containers from problem creation (the
+        # outputs are expressions of the states, so they carry no guesses)
         U = self.opti_vars['U']
         X = self.opti_vars['X']
-        Y = self.opti_vars['Y']
 
-        self.opti.set_initial(Y[0], y_init)
-        for k in range(Np):
-            self.opti.set_initial(U[k], u_init)
-            self.opti.set_initial(X[k], x_init)
-            self.opti.set_initial(Y[k+1], y_init)
+        # one set_initial call per trajectory using the guess tiles
+        # precomputed in get_mpc()
+        self.opti.set_initial(U, self._u_init_tile)
+        self.opti.set_initial(X, self._x_init_tile)
+
+        # reset the warm-start vectors used by the cached solver Function
+        self._x_ws = cas.DM(self._x_ws0)
+        self._lam_ws = cas.DM.zeros(self.opti.lam_g.size1())
 
     def set_parameters(self, params_list):
         """
@@ -365,19 +475,20 @@ class EconomicMPC(MPC):
         as the opti_param keys.
         """
 
-        # unpack parameter containers
-        X0 = self.opti_params['X0']
-        CEMref = self.opti_params['CEMref']
-        CEM0 = self.opti_params['CEM0']
+        # unpack parameter container
+        P = self.opti_params['P']
 
         # unpack params_list argument
         x0 = params_list[0]
         cemRef = params_list[1]
         cem0 = params_list[2]
 
-        # reset initial and target CEM
-        self.opti.set_value(CEM0, cem0)
-        self.opti.set_value(CEMref, cemRef)
+        # store the values for the cached solver Function used by solve_mpc()
+        self._x0_val = np.ravel(x0)
+        self._cemref_val = np.ravel(cemRef)
+        self._cem0_val = np.ravel(cem0)
 
-        # reset initial condition
-        self.opti.set_value(X0, x0)
+        # reset initial state and initial/target CEM with a single set_value
+        # call on the stacked parameter vector
+        self._p_val = np.concatenate([self._x0_val, self._cemref_val, self._cem0_val])
+        self.opti.set_value(P, self._p_val)
@@ -71,9 +71,9 @@ class Simulation():
             self.v_noise_generation = 'uniform'
 
         if 'w_mu' in prob_info.keys() and 'w_sigma' in prob_info.keys():
-            self.v_mu = prob_info['w_mu']
-            self.v_sigma = prob_info['w_sigma']
-            self.v_noise_generation = 'normal'
+            self.w_mu = prob_info['w_mu']
+            self.w_sigma = prob_info['w_sigma']
+            self.w_noise_generation = 'normal'
         elif 'w_max' in prob_info.keys() and 'w_min' in prob_info.keys():
             self.w_min = prob_info['w_min']
             self.w_max = prob_info['w_max']
@@ -84,9 +84,19 @@ class Simulation():
             self.w_max = np.zeros((self.nw,))
             self.w_noise_generation = 'uniform'
 
+        # contiguous copies of the input bounds for clipping approximate
+        # (DNN) controller outputs inside the simulation loop
+        self._u_lo = np.ascontiguousarray(prob_info['u_min'], dtype=np.float64)
+        self._u_hi = np.ascontiguousarray(prob_info['u_max'], dtype=np.float64)
+
         self.x0 = prob_info['x0'] # initial state/point
         self.hp = prob_info['hp'] # output equation for the 'real' system (plant)
         self.fp = prob_info['fp'] # dynamics equation for the plant
+        # mapped version of the plant output equation; evaluates the output
+        # over a whole state trajectory in a single CasADi call (the loop in
+        # C++ rather than Python) whenever the outputs are not needed inside
+        # the feedback loop
+        self.hp_map = self.hp.map(self.Nsim+1)
         self.myref = prob_info['myref'] # reference function for the controlled output
         self.ts = prob_info['ts'] # simulation sampling time
         self.rand_seed = prob_info['rand_seed'] # random seed
@@ -133,14 +143,14 @@ class Simulation():
             rng = default_rng(self.rand_seed+rand_seed2)
 
         if self.v_noise_generation == 'uniform':
-            Vsim = rng.random(size=(self.nv,self.Nsim+1)) * (self.v_max-self.v_min)[:,None] + self.v_min[:,None]
+            Vsim = rng.uniform(self.v_min[:,None], self.v_max[:,None], size=(self.nv,self.Nsim+1))
         elif self.v_noise_generation == 'normal':
             Vsim = rng.normal(self.v_mu, self.v_sigma, size=(self.nv,self.Nsim+1))
         else:
             print('Unknown/unsupported form of noise generation!')
             raise
         if self.w_noise_generation == 'uniform':
-            Wsim = rng.random(size=(self.nw,self.Nsim)) * (self.w_max-self.w_min)[:,None] + self.w_min[:,None]
+            Wsim = rng.uniform(self.w_min[:,None], self.w_max[:,None], size=(self.nw,self.Nsim))
         elif self.w_noise_generation == 'normal':
             Wsim = rng.normal(self.w_mu, self.w_sigma, size=(self.nw,self.Nsim+1))
         else:
@@ -154,8 +164,11 @@ class Simulation():
         Xhat = np.zeros_like(Xsim)  # state estimation
         Dhat = np.zeros((self.nd,self.Nsim+1))
         if multistage:
-            Ypred = [0 for i in range(self.Nsim)]
-            Wpred = [0 for i in range(self.Nsim)]
+            # dense arrays (mirroring the non-multistage branch) instead of
+            # Python lists of CasADi DMs, so downstream consumers get
+            # contiguous NumPy data without per-element conversion
+            Ypred = np.zeros((self.ny,self.prob_info['Np']+1,self.Nsim))
+            Wpred = np.zeros((self.nw,self.prob_info['Np'],self.Nsim))
         else:
             Ypred = np.zeros((self.ny,self.prob_info['Np'],self.Nsim))
 
@@ -166,19 +179,31 @@ class Simulation():
 
         ctime = np.zeros(self.Nsim)   # computation time
         Jsim = np.zeros(self.Nsim)    # cost/optimal objective value (controller)
-        Yrefsim = np.zeros((self.nyc,self.Nsim+1))  # output reference/target (as sent to controller)
         Feas = np.zeros(self.Nsim)
+
+        # output reference/target (as sent to controller); the full reference
+        # trajectory is computed up-front so the reference function is not
+        # called inside the simulation loop
+        ts_vec = np.arange(self.Nsim+1)*self.ts
+        Yrefsim = np.asarray([self.myref(t) for t in ts_vec]).reshape(self.Nsim+1,self.nyc).T
         if CEM:
             CEMsim = np.zeros((1,self.Nsim+1))  # CEM trajectory
             CEM_stop_time = self.Nsim+1
 
+        # the plant outputs only need to be computed inside the loop when they
+        # are fed back (through an observer or the CEM accumulation);
+        # otherwise they are batch-evaluated after the loop via the mapped
+        # output function
+        batch_outputs = (observer is None) and (not CEM)
+
         # set initial states and reset controller for consistency
         Xsim[:,0] = np.ravel(self.x0)
         Xhat[:,0] = Xsim[:,0]
         if observer is not None:
             observer.xhat = Xhat[:,0]
             observer.dhat = Dhat[:,0]
-        Ysim[:,0] = np.ravel(self.hp(Xsim[:,0],Vsim[:,0]).full())
+        if not batch_outputs:
+            Ysim[:,0] = np.asarray(self.hp(Xsim[:,0],Vsim[:,0])).reshape(-1)
 
         if mpc_controller:
             c.reset_initial_guesses()
@@ -186,9 +211,8 @@ class Simulation():
         # loop over simulation time
         CEM_stop_trigger = False
         for k in range(self.Nsim):
-            startTime = time.time()
+            startTime = time.perf_counter_ns()
 
-            Yrefsim[:,k] = self.myref(k*self.ts)
             if mpc_controller:
                 if CEM:
                     if multistage:
@@ -204,8 +228,8 @@ class Simulation():
                 Uopt = res['U']
                 Jopt = res['J']
                 if multistage:
-                    Ypred[k] = res['Y'] # todo: add functionality to other controllers, then move this out of conditional statement
-                    Wpred[k] = res['wPred']
+                    Ypred[:,:,k] = np.asarray(res['Y']) # todo: add functionality to other controllers, then move this out of conditional statement
+                    Wpred[:,:,k] = np.asarray(res['wPred'])
             else:
                 Jopt = np.nan
 
@@ -213,10 +237,10 @@ class Simulation():
                     in_vec = np.concatenate((Xhat[:,k], CEMsim[:,k]))
                 else:
                     in_vec = np.concatenate((Xhat[:,k], Yrefsim[:,k]))
-                Uopt = np.ravel((c.netca(in_vec)).full())
-                Uopt = np.maximum(np.minimum(Uopt, self.prob_info['u_max']), self.prob_info['u_min'])
+                Uopt = np.asarray(c.netca(in_vec)).reshape(-1)
+                np.clip(Uopt, self._u_lo, self._u_hi, out=Uopt)
 
-            ctime[k] = time.time() - startTime
+            ctime[k] = (time.perf_counter_ns() - startTime) * 1e-9
             if mpc_controller:
                 if not feas:
                     print('Was not feasible on iteration {} of simulation'.format(k))
@@ -229,11 +253,13 @@ class Simulation():
             Usim[:,k] = np.ravel(Uopt)
             Jsim[k] = Jopt
 
-            # send optimal input to plant/real system
-            Xsim[:,k+1] = np.ravel(self.fp(Xsim[:,k],Usim[:,k],Wsim[:,k]).full())
-            Ysim[:,k+1] = np.ravel(self.hp(Xsim[:,k+1],Vsim[:,k+1]).full())
+            # send optimal input to plant/real system; np.asarray converts the
+            # returned DM without the extra dense copy made by .full()
+            Xsim[:,k+1] = np.asarray(self.fp(Xsim[:,k],Usim[:,k],Wsim[:,k])).reshape(-1)
+            if not batch_outputs:
+                Ysim[:,k+1] = np.asarray(self.hp(Xsim[:,k+1],Vsim[:,k+1])).reshape(-1)
             if CEM:
-                CEMsim[:,k+1] = CEMsim[:,k] + np.ravel(self.prob_info['CEMadd'](Ysim[:,k+1]).full())
+                CEMsim[:,k+1] = CEMsim[:,k] + np.asarray(self.prob_info['CEMadd'](Ysim[:,k+1])).reshape(-1)
                 if not CEM_stop_trigger and CEMsim[:,k+1] > Yrefsim[:,k]:
                     CEM_stop_time = k+1
                     CEM_stop_trigger = True
@@ -248,7 +274,32 @@ class Simulation():
             else:
                 Xhat[:,k+1] = Xsim[:,k+1]
 
-        Yrefsim[:,k+1] = self.myref((k+1)*self.ts)
+        if batch_outputs:
+            # evaluate the plant outputs over the whole state trajectory in
+            # one mapped call
+            Ysim[:,:] = self.hp_map(Xsim, Vsim).full()
+
+        if CEM and CEM_stop_trigger:
+            # the dose target was met before the simulation horizon ran out;
+            # return only the populated portion of each trajectory instead of
+            # full-length containers padded with trailing zeros
+            K = CEM_stop_time
+            Xsim = Xsim[:,:K+1]
+            Ysim = Ysim[:,:K+1]
+            Usim = Usim[:,:K]
+            Jsim = Jsim[:K]
+            Wsim = Wsim[:,:K]
+            Vsim = Vsim[:,:K+1]
+            Yrefsim = Yrefsim[:,:K+1]
+            ctime = ctime[:K]
+            Feas = Feas[:K]
+            Xhat = Xhat[:,:K+1]
+            Dhat = Dhat[:,:K+1]
+            CEMsim = CEMsim[:,:K+1]
+            Ypred = Ypred[:,:,:K]
+            if multistage:
+                Wpred = Wpred[:,:,:K]
+
         # create dictionary of simulation data
         sim_data = {}
         sim_data['Xsim'] = Xsim